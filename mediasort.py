@@ -2,21 +2,40 @@ import os
 import re
 import time
 import json
+import math
 import hashlib
 import ffmpeg
-import mimetypes
 import shutil
+import sqlite3
 import logging
 import base64
-from dataclasses import dataclass
+import struct
+import mmap
+import atexit
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
-from copy import deepcopy
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 from tqdm import tqdm
-from PIL import Image, ExifTags
+from PIL import Image, ExifTags, UnidentifiedImageError
 from PIL.TiffImagePlugin import IFDRational
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def get_logger():
     logger = logging.getLogger(__name__)
@@ -41,42 +60,328 @@ logger = get_logger()
 
 def exif_encoder(obj):
     if isinstance(obj, IFDRational):
-        return float(obj)
+        # e.g. 0/0, which is NaN
+        value = float(obj)
+        return value if math.isfinite(value) else None
     elif isinstance(obj, bytes):
         return base64.b64encode(obj).decode("utf-8")
     raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
-def file_type(path: Path | str) -> str:
-    mime_type, _ = mimetypes.guess_type(str(path))
-    if not mime_type:
-        return "other"
-    if mime_type.startswith("image"):
+def dump_json(obj) -> str | None:
+    """
+    Encode metadata for the cache. Returns None if it can't be encoded,
+    in which case it's simply read from the file again.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=exif_encoder).decode("utf-8")
+        except TypeError:
+            # e.g. integers that don't fit into 64 bits, let the standard library handle them
+            pass
+    try:
+        # NaN and Infinity aren't valid JSON and orjson refuses to read them
+        return json.dumps(obj, default=exif_encoder, allow_nan=False)
+    except ValueError:
+        return None
+
+
+def load_json(s: str):
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # e.g. NaN written by an older version without orjson
+            pass
+    return json.loads(s)
+
+
+IMAGE_EXTENSIONS = frozenset({
+    ".jpg", ".jpeg", ".jpe", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp", ".heic", ".heif", ".avif",
+    # camera RAW
+    ".raw", ".cr2", ".cr3", ".nef", ".nrw", ".arw", ".dng", ".orf", ".rw2", ".raf", ".pef", ".srw",
+})
+VIDEO_EXTENSIONS = frozenset({
+    ".mp4", ".m4v", ".mov", ".qt", ".avi", ".mkv", ".mpg", ".mpeg", ".mpe", ".m1v", ".webm",
+    ".3gp", ".3g2", ".mts", ".m2ts", ".wmv",
+})
+
+
+def file_type(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
         return "image"
-    elif mime_type.startswith("video"):
+    elif ext in VIDEO_EXTENSIONS:
         return "video"
     else:
         return "other"
 
 
-def image_metadata(path: Path | str):
-    with Image.open(path) as img:
-        meta = {}
-        for k, v in img.getexif().items():
-            if k in ExifTags.TAGS:
-                meta[ExifTags.TAGS[k]] = v
+EXIF_DATETIME_TAGS = {0x0132: "DateTime", 0x9003: "DateTimeOriginal"}
+EXIF_IFD_POINTER = 0x8769
+EXIF_ASCII = 2
+
+
+def tiff_datetimes(tiff: bytes):
+    """
+    Extract DateTime and DateTimeOriginal from a TIFF structure (the payload of EXIF).
+    """
+    endian = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if endian is None:
+        return None
+    meta = {}
+    # IFD0 holds DateTime and a pointer to the Exif IFD, which holds DateTimeOriginal
+    offsets = list(struct.unpack_from(endian + "I", tiff, 4))
+    for offset in offsets:
+        (n_entries,) = struct.unpack_from(endian + "H", tiff, offset)
+        for i in range(n_entries):
+            tag, typ, count, value = struct.unpack_from(endian + "HHI4s", tiff, offset + 2 + 12 * i)
+            if tag == EXIF_IFD_POINTER and len(offsets) == 1:
+                offsets.extend(struct.unpack(endian + "I", value))
+            elif tag in EXIF_DATETIME_TAGS and typ == EXIF_ASCII:
+                if count > 4:
+                    (value_offset,) = struct.unpack(endian + "I", value)
+                    value = tiff[value_offset:value_offset + count]
+                if len(value) < count:
+                    raise struct.error("EXIF value is out of bounds")
+                meta[EXIF_DATETIME_TAGS[tag]] = value[:count].split(b"\0", 1)[0].decode("ascii", "replace")
+    return meta
+
+
+def jpeg_exif_metadata(path: str):
+    """
+    Read EXIF dates from the APP1 segment of a JPEG without involving an image library.
+    Returns None if the file is not a JPEG or the EXIF block can't be parsed.
+    """
+    with open(path, "rb") as fp:
+        if fp.read(2) != b"\xff\xd8":
+            return None
+        try:
+            # walk segment headers and only read the payload of APP1,
+            # so that large segments before it (thumbnails, ICC profiles) don't matter
+            while True:
+                header = fp.read(4)
+                if len(header) < 4 or header[0] != 0xFF:
+                    return None
+                marker = header[1]
+                if marker == 0xFF:
+                    # fill byte
+                    fp.seek(-3, os.SEEK_CUR)
+                    continue
+                if marker == 0xDA:
+                    # start of scan, no EXIF in the header
+                    return {}
+                (length,) = struct.unpack(">H", header[2:])
+                if length < 2:
+                    return None
+                if marker == 0xE1:
+                    payload = fp.read(length - 2)
+                    # APP1 may also hold XMP
+                    if payload[:6] == b"Exif\0\0":
+                        return tiff_datetimes(payload[6:])
+                else:
+                    fp.seek(length - 2, os.SEEK_CUR)
+        except struct.error:
+            return None
+
+
+def image_metadata(path: str):
+    meta = jpeg_exif_metadata(path)
+    if meta is not None:
+        return meta
+    # not a JPEG or EXIF we can't parse ourselves; Image.open() only reads
+    # the header, pixel data is never loaded here
+    try:
+        with Image.open(path) as img:
+            exif = img.getexif()
+            meta = {}
+            # IFD0 tags and the Exif IFD, which holds DateTimeOriginal
+            for tags in (exif, exif.get_ifd(EXIF_IFD_POINTER)):
+                for k, v in tags.items():
+                    if k in ExifTags.TAGS:
+                        meta[ExifTags.TAGS[k]] = v
+    except (UnidentifiedImageError, OSError):
+        # format Pillow can't read (e.g. some RAW files) or a broken file,
+        # record time then falls back to the path
+        return {}
     return meta
 
 
-def video_metadata(path: Path | str):
-    return ffmpeg.probe(path)
+# top-level atoms that a MP4 / QuickTime file may start with
+MP4_FIRST_ATOMS = frozenset({b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"})
+# seconds between 1904-01-01 (MP4 epoch) and 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+
+
+def mp4_creation_time(path: str):
+    """
+    Read creation time (seconds since 1904) from the moov/mvhd atom of a MP4 / QuickTime file.
+    Returns None if the file is not MP4 or mvhd can't be found.
+    """
+    with open(path, "rb") as fp:
+        container_end = os.fstat(fp.fileno()).st_size
+        is_first = True
+        while fp.tell() + 8 <= container_end:
+            start = fp.tell()
+            size, kind = struct.unpack(">I4s", fp.read(8))
+            if is_first and kind not in MP4_FIRST_ATOMS:
+                return None
+            is_first = False
+            header_size = 8
+            if size == 1:
+                # 64-bit size follows the type
+                (size,) = struct.unpack(">Q", fp.read(8))
+                header_size = 16
+            elif size == 0:
+                # atom extends to the end of the file
+                size = container_end - start
+            if size < header_size:
+                return None
+            if kind == b"moov":
+                # descend into moov
+                container_end = start + size
+                continue
+            if kind == b"mvhd":
+                version = fp.read(4)[0]
+                fmt = ">Q" if version == 1 else ">I"
+                (creation_time,) = struct.unpack(fmt, fp.read(struct.calcsize(fmt)))
+                return creation_time
+            fp.seek(start + size)
+    return None
+
+
+# container tags are read while opening, so there's no need to analyze streams deeply
+AV_OPTIONS = {"probesize": "32768"}
+
+
+def av_metadata(path: str):
+    """
+    Read container and stream tags in-process using PyAV.
+    Returns the same structure as ffprobe, but only with tags.
+    """
+    with av.open(path, options=AV_OPTIONS, metadata_errors="ignore") as container:
+        return {
+            "format": {"tags": dict(container.metadata)},
+            "streams": [{"tags": dict(stream.metadata)} for stream in container.streams],
+        }
+
+
+def video_metadata(path: str):
+    try:
+        creation_time = mp4_creation_time(path)
+    except (struct.error, IndexError):
+        creation_time = None
+    if creation_time is None:
+        if av is not None:
+            try:
+                return av_metadata(path)
+            except av.FFmpegError:
+                pass
+        # runs ffprobe in a subprocess, which is much slower
+        return ffmpeg.probe(path)
+    # same structure as ffprobe output, but only with the tag we use;
+    # zero means unset, and like ffmpeg we treat values below the epoch offset
+    # as Unix time (some encoders write it this way)
+    tags = {}
+    if creation_time:
+        if creation_time >= MP4_EPOCH_OFFSET:
+            creation_time -= MP4_EPOCH_OFFSET
+        dt = datetime(1970, 1, 1) + timedelta(seconds=creation_time)
+        tags["creation_time"] = dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return {"format": {"tags": tags}}
+
+
+HASH_BUFFER_SIZE = 1 << 20
+# larger files are hashed directly from a memory map, without copying to a buffer
+HASH_MMAP_THRESHOLD = 4 << 20
+# BLAKE3 uses SIMD and is several times faster than SHA-1, use it if installed
+HASH_ALGO = "blake3" if blake3 is not None else "sha1"
+
+
+def new_hash():
+    return blake3.blake3() if HASH_ALGO == "blake3" else hashlib.sha1()
+
+
+def hash_file(path: str):
+    """
+    Compute hash (see HASH_ALGO) of a file, streaming it in chunks instead of
+    reading it into memory.
+    """
+    if HASH_ALGO == "blake3" and os.path.getsize(path) > HASH_MMAP_THRESHOLD:
+        # blake3 maps the file itself and splits large inputs between threads
+        h = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        h.update_mmap(path)
+        return h.hexdigest()
+    with open(path, "rb", buffering=0) as fp:
+        if os.fstat(fp.fileno()).st_size > HASH_MMAP_THRESHOLD:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    # read ahead aggressively and drop pages soon after use
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h = new_hash()
+                h.update(mm)
+        elif hasattr(hashlib, "file_digest"):
+            # Python 3.11+: hashes in a C loop with the GIL released
+            h = hashlib.file_digest(fp, new_hash)
+        else:
+            # reuse one buffer instead of allocating a new bytes object per chunk
+            h = new_hash()
+            buf = bytearray(HASH_BUFFER_SIZE)
+            view = memoryview(buf)
+            while n := fp.readinto(buf):
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+SHORT_HASH_SIZE = 64 * 1024
+
+
+def short_hash_file(path: str, size: int):
+    """
+    Compute SHA-1 of the first and the last SHORT_HASH_SIZE bytes of a file.
+    Cheap way to tell apart most files of the same size.
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        h.update(fp.read(SHORT_HASH_SIZE))
+        fp.seek(max(0, size - SHORT_HASH_SIZE))
+        h.update(fp.read(SHORT_HASH_SIZE))
+    return h.hexdigest()
+
+
+# covers:
+# /path/to/2010/05/image.jpg
+# /path/to/2010/subdir/image.jpg
+PATH_DATE_RE = re.compile(r".*/(19\d{2}|20\d{2})/(\d{1,2}/)?")
+# directory names like "2010-05-01" or "2010.05"
+DATE_DIR_RE = re.compile(r"^[0-9\-\._ ]+$")
+
+
+def parse_exif_datetime(s: str):
+    """
+    Faster equivalent of datetime.strptime(s, "%Y:%m:%d %H:%M:%S").
+    """
+    if len(s) != 19:
+        raise ValueError(f"Invalid EXIF datetime: {s!r}")
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+
+def parse_iso_datetime(s: str):
+    """
+    Faster equivalent of datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%fZ").
+    """
+    if not (21 <= len(s) <= 27 and s[19] == "." and s[-1] == "Z"):
+        raise ValueError(f"Invalid ISO datetime: {s!r}")
+    microsecond = int(s[20:-1].ljust(6, "0"))
+    return datetime(
+        int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]), microsecond
+    )
 
 
 def datetime_from_path(path: str):
-    # covers:
-    # /path/to/2010/05/image.jpg
-    # /path/to/2010/subdir/image.jpg
-    matched = re.search(r".*/(19\d{2}|20\d{2})/(\d{1,2}/)?", path)
+    # the pattern starts with ".*", so match() finds the same result as search(),
+    # but gives up after one attempt instead of retrying at every position
+    matched = PATH_DATE_RE.match(path)
     if matched:
         year_str, month_str = matched.groups()
         year = int(year_str)
@@ -85,34 +390,83 @@ def datetime_from_path(path: str):
     return None
 
 
-@dataclass
+# marks lazily computed attributes for which None is a valid value
+NOT_COMPUTED = object()
+
+
+# slots save a per-instance __dict__, which matters for indexes of millions of files
+@dataclass(slots=True)
 class FileDescriptor:
     path: str
     size: int
-    hash: str
+    hash: str | None
     typ: str
+    mtime_ns: int | None = None
     _meta: dict | None = None
+    _short_hash: str | None = None
+    # cached properties; record time is expensive to get, so it's persisted too
+    _record_time: datetime | None = field(default=NOT_COMPUTED, repr=False, compare=False)
+    _name: str | None = field(default=None, init=False, repr=False, compare=False)
+    _album: str | None = field(default=NOT_COMPUTED, init=False, repr=False, compare=False)
 
     @staticmethod
     def from_file(path: Path | str):
-        path = str(path)
-        with open(path, "rb") as fp:
-            content = fp.read()
-        size = len(content)
-        hash = hashlib.sha1(content).hexdigest()
+        fd = FileDescriptor.from_stat(str(path))
+        fd.compute_hash()
+        return fd
+
+    @staticmethod
+    def from_stat(path: str, st: os.stat_result | None = None):
+        """
+        Create a descriptor without reading the file. The hash is left empty
+        and can be filled later using compute_hash().
+        """
+        st = st or os.stat(path)
         typ = file_type(path)
-        return FileDescriptor(path=path, size=size, hash=hash, typ=typ)
+        return FileDescriptor(path=path, size=st.st_size, hash=None, typ=typ, mtime_ns=st.st_mtime_ns)
 
     @staticmethod
     def from_dict(dct: dict):
         return FileDescriptor(**dct)
 
+    @staticmethod
+    def from_row(row: tuple):
+        path, size, hash, typ, meta, short_hash, hash_algo, mtime_ns, record_time = row
+        meta = load_json(meta) if meta is not None else None
+        # NULL - not computed yet, "" - computed, but no date found
+        if record_time is None:
+            record_time = NOT_COMPUTED
+        else:
+            record_time = datetime.fromisoformat(record_time) if record_time else None
+        if (hash_algo or "sha1") != HASH_ALGO:
+            # hashed with another algorithm, e.g. before blake3 was installed
+            hash = None
+        # type is cheap to get and the list of extensions may have changed since the file was indexed
+        typ = file_type(path)
+        return FileDescriptor(
+            path=path, size=size, hash=hash, typ=typ, mtime_ns=mtime_ns,
+            _meta=meta, _short_hash=short_hash, _record_time=record_time,
+        )
+
     def __repr__(self):
         return f"FileDescriptor(path='{self.path}', size={self.size})"
 
+    def to_row(self):
+        meta = dump_json(self._meta) if self._meta is not None else None
+        if self._record_time is NOT_COMPUTED:
+            record_time = None
+        else:
+            record_time = self._record_time.isoformat() if self._record_time else ""
+        return (
+            self.path, self.size, self.hash, self.typ, meta, self._short_hash, HASH_ALGO, self.mtime_ns,
+            record_time,
+        )
+
     @property
     def name(self):
-        return os.path.basename(self.path)
+        if self._name is None:
+            self._name = os.path.basename(self.path)
+        return self._name
 
     @property
     def meta(self):
@@ -124,28 +478,66 @@ class FileDescriptor:
             # otherwise: keep _meta == None
         return self._meta
 
+    @property
+    def short_hash(self):
+        if self._short_hash is None:
+            self._short_hash = short_hash_file(self.path, self.size)
+        return self._short_hash
+
+    def compute_hash(self):
+        if self.hash is None:
+            self.hash = hash_file(self.path)
+        return self.hash
+
     def is_same(self, other):
         # in practice, I haven't found any collisions even with the hash itself
         # for just in case let's also check the file size
-        return self.hash == other.hash and self.size == other.size
+        if self.size != other.size:
+            return False
+        try:
+            if self.hash is None or other.hash is None:
+                # avoid reading whole files if they already differ in the head or tail
+                if self.size > 2 * SHORT_HASH_SIZE and self.short_hash != other.short_hash:
+                    return False
+            return self.compute_hash() == other.compute_hash()
+        except FileNotFoundError:
+            # e.g. a destination file deleted after it was indexed
+            return False
         # self_dt = self.record_time or datetime(1, 1, 1)
         # other_dt = other.record_time or datetime(1, 1, 1)
         # return self.hash == other.hash and self_dt.year == other_dt.year and self_dt.month == other_dt.month
 
     @property
     def record_time(self):
+        if self._record_time is NOT_COMPUTED:
+            self._record_time = self.read_record_time()
+        return self._record_time
+
+    def read_record_time(self):
         # empty files have no metadata, so we give up on them
         if self.size == 0:
             return None
         dt = None
         # try to extract datetime from metadata
         if self.typ == "image":
-            dts = self.meta.get("DateTimeOriginal") or self.meta.get("DateTime")
-            dt = datetime.strptime(dts, "%Y:%m:%d %H:%M:%S") if dts else None
+            for tag in ("DateTimeOriginal", "DateTime"):
+                dts = self.meta.get(tag)
+                if not dts:
+                    continue
+                try:
+                    dt = parse_exif_datetime(dts)
+                    break
+                except ValueError:
+                    # cameras often write zeros or blanks when the clock isn't set
+                    pass
         elif self.typ == "video":
             from_tag = self.meta.get("format", {}).get("tags", {}).get("creation_time")
             if from_tag and not from_tag.startswith("1970"):
-                dt = datetime.strptime(from_tag, "%Y-%m-%dT%H:%M:%S.%fZ")
+                try:
+                    dt = parse_iso_datetime(from_tag)
+                except ValueError:
+                    # other formats, e.g. "2019-07-01 10:11:12" in AVI
+                    pass
         # as a last resort, try to extract datetime from path
         if dt is None:
             dt = datetime_from_path(self.path)
@@ -153,74 +545,339 @@ class FileDescriptor:
 
     @property
     def album(self):
-        album = os.path.basename(os.path.dirname(self.path))
-        if not re.match(r"^[0-9\-\._ ]+$", album):
-            # doesn't look like a date
-            return album
-        return None
+        if self._album is NOT_COMPUTED:
+            album = os.path.basename(os.path.dirname(self.path))
+            # use directory name unless it looks like a date
+            self._album = album if not DATE_DIR_RE.match(album) else None
+        return self._album
 
 
 ###############################################################################
 #                                    Index                                    #
 ###############################################################################
 
+def full_hash_candidates(groups: list[list[FileDescriptor]], max_workers: int | None = None):
+    """
+    Given groups of same-size files, return files that need a full hash, i.e.
+    files whose short hash collides with another file in the same group.
+    """
+    # groups where everything is hashed are already resolved
+    groups = [g for g in groups if len(g) > 1 and any(fd.hash is None for fd in g)]
+    # for small files the short hash reads as much as the full one, so we don't bother
+    large = [fd for g in groups if g[0].size > 2 * SHORT_HASH_SIZE for fd in g if fd._short_hash is None]
+    if large:
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as ex:
+            paths, sizes = [fd.path for fd in large], [fd.size for fd in large]
+            results = ex.map(short_hash_file, paths, sizes)
+            for fd, short_hash in tqdm(zip(large, results), total=len(large)):
+                fd._short_hash = short_hash
+    candidates = []
+    for g in groups:
+        if g[0].size > 2 * SHORT_HASH_SIZE:
+            by_short_hash = defaultdict(lambda: [])
+            for fd in g:
+                by_short_hash[fd.short_hash].append(fd)
+            candidates.extend(fd for sg in by_short_hash.values() if len(sg) > 1 for fd in sg)
+        else:
+            candidates.extend(g)
+    return candidates
+
+
+def iter_files(root: str):
+    """
+    Recursively yield (path, stat_result) of all regular files under root.
+    Uses os.scandir, so file type comes from the directory listing without extra stat().
+    """
+    # explicit stack instead of recursion, so that each file isn't passed
+    # through a chain of nested generators
+    stack = [iter(sorted_entries(root))]
+    while stack:
+        for entry in stack[-1]:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(iter(sorted_entries(entry.path)))
+                break
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat(follow_symlinks=False)
+        else:
+            stack.pop()
+
+
+def sorted_entries(dirpath: str):
+    try:
+        with os.scandir(dirpath) as it:
+            return sorted(it, key=lambda e: e.name)
+    except OSError as ex:
+        # e.g. no permission, skip the directory like Path.rglob() did
+        logger.warning(f"Failed to list {dirpath} because of {repr(ex)}")
+        return []
+
+
+# column -> SQL type, in the order of FileDescriptor.to_row()
+CACHE_COLUMNS = {
+    "path": "TEXT PRIMARY KEY",
+    "size": "INTEGER",
+    "hash": "TEXT",
+    "typ": "TEXT",
+    "meta": "TEXT",
+    "short_hash": "TEXT",
+    "hash_algo": "TEXT",
+    "mtime_ns": "INTEGER",
+    "record_time": "TEXT",
+}
+# bump when metadata parsing changes, so that cached metadata and record times are read again
+METADATA_VERSION = 1
+
+
+def init_cache_db(db: sqlite3.Connection):
+    # the cache can always be rebuilt, so trade durability of the last
+    # transactions for fewer fsync() calls
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    columns = ", ".join(f"{name} {typ}" for name, typ in CACHE_COLUMNS.items())
+    db.execute(f"CREATE TABLE IF NOT EXISTS files ({columns})")
+    # caches created by older versions may lack some of the columns
+    existing = {row[1] for row in db.execute("PRAGMA table_info(files)")}
+    for name, typ in CACHE_COLUMNS.items():
+        if name not in existing:
+            db.execute(f"ALTER TABLE files ADD COLUMN {name} {typ}")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files(hash)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_files_size ON files(size)")
+    (version,) = db.execute("PRAGMA user_version").fetchone()
+    if version < METADATA_VERSION:
+        db.execute("UPDATE files SET meta = NULL, record_time = NULL")
+        db.execute(f"PRAGMA user_version = {METADATA_VERSION}")
+    db.commit()
+
+
+# number of files added or hashed one by one before they are written to the cache
+CACHE_BATCH_SIZE = 128
+
+
 class Index:
     def __init__(self, cachefile: str | None = None, recreate=False):
-        self.cachefile = cachefile or os.path.abspath("media-index.jsonl")
+        self.cachefile = cachefile or os.path.abspath("media-index.db")
         if recreate and os.path.exists(self.cachefile):
             os.remove(self.cachefile)
-        self.items = []
-        self.hashes = defaultdict(lambda: [])    # hash -> [fd]
-        self.paths = defaultdict(lambda: [])     # path -> [fd]
-        self.update_from_cache(self.cachefile)
+        is_new = not os.path.exists(self.cachefile)
+        self.db = sqlite3.connect(self.cachefile)
+        init_cache_db(self.db)
+        self.items: dict[str, FileDescriptor] = {}           # path -> fd, removal by path is O(1)
+        # snapshot of items for index[i], built on first access after a change
+        self._items_list: list[FileDescriptor] | None = None
+        # plain dicts, so that lookups of missing keys don't insert empty lists
+        self.hashes: dict[str, list[FileDescriptor]] = {}    # only for hashed files
+        self.paths: dict[str, list[FileDescriptor]] = {}
+        self.sizes: dict[int, list[FileDescriptor]] = {}
+        self.pending = []                        # added, but not yet written to the cache
+        atexit.register(self.flush)
+        self.update_from_cache()
+        # migrate from the old JSONL cache, e.g. media-index.jsonl -> media-index.db
+        legacy_cachefile = os.path.splitext(self.cachefile)[0] + ".jsonl"
+        if is_new and not recreate and os.path.exists(legacy_cachefile):
+            self.update_from_jsonl(legacy_cachefile)
 
     def __repr__(self):
         return f"Index(cachefile='{self.cachefile}', len={len(self.items)})"
 
     def __iter__(self):
-        return iter(self.items)
+        return iter(self.items.values())
 
     def __len__(self):
         return len(self.items)
 
     def __getitem__(self, i):
-        return self.items[i]
-
-    def update_from_cache(self, cachefile: str):
-        logger.info(f"Pre-loading index from {cachefile}")
-        if os.path.exists(cachefile):
-            with open(cachefile) as fp:
-                lines = fp.readlines()
-            for line in tqdm(lines):
-                dct = json.loads(line)
-                fd = FileDescriptor.from_dict(dct)
-                self.add(fd)
-
-    def add(self, fd: FileDescriptor):
-        existing = self.hashes[fd.hash]
-        if existing and any(fd.path == e.path for e in existing):
-            # file already added to the index
-            return False
-        self.items.append(fd)
-        self.hashes[fd.hash].append(fd)
-        self.paths[fd.path].append(fd)
+        if self._items_list is None:
+            self._items_list = list(self.items.values())
+        return self._items_list[i]
+
+    def update_from_cache(self):
+        logger.info(f"Pre-loading index from {self.cachefile}")
+        columns = ", ".join(CACHE_COLUMNS)
+        rows = self.db.execute(f"SELECT {columns} FROM files ORDER BY path").fetchall()
+        for row in tqdm(rows):
+            self.add(FileDescriptor.from_row(row), write_cache=False)
+
+    def update_from_jsonl(self, jsonl: str):
+        logger.info(f"Importing index from {jsonl}")
+        with open(jsonl) as fp:
+            lines = fp.readlines()
+        # a file may be written several times (e.g. first without hash, then
+        # with it), the last record wins
+        records = {}
+        for line in tqdm(lines):
+            dct = json.loads(line)
+            if HASH_ALGO != "sha1":
+                # the JSONL cache always used SHA-1
+                dct["hash"] = None
+            # metadata was parsed by an older version, read it again (see METADATA_VERSION)
+            dct["_meta"] = None
+            records[dct["path"]] = dct
+        fds = [FileDescriptor.from_dict(dct) for dct in records.values()]
+        self.write_to_cache([fd for fd in fds if self.add(fd, write_cache=False)])
+
+    def write_to_cache(self, fds: list[FileDescriptor]):
         try:
-            with open(self.cachefile, "a") as fp:
-                fp.write(json.dumps(fd.__dict__, default=exif_encoder) + "\n")
+            with self.db:
+                self.db.executemany(
+                    f"INSERT OR REPLACE INTO files ({', '.join(CACHE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in CACHE_COLUMNS)})",
+                    [fd.to_row() for fd in fds]
+                )
         except Exception as ex:
-            logger.warning(f"Failed to write {fd} to the cache because of {repr(ex)}")
+            logger.warning(f"Failed to write {len(fds)} files to the cache because of {repr(ex)}")
+
+    def delete_from_cache(self, fds: list[FileDescriptor]):
+        try:
+            with self.db:
+                self.db.executemany("DELETE FROM files WHERE path = ?", [(fd.path,) for fd in fds])
+        except Exception as ex:
+            logger.warning(f"Failed to delete {len(fds)} files from the cache because of {repr(ex)}")
+
+    def add(self, fd: FileDescriptor, write_cache=True):
+        if fd.path in self.paths:
+            # file already added to the index
+            return False
+        self.items[fd.path] = fd
+        self._items_list = None
+        self.sizes.setdefault(fd.size, []).append(fd)
+        self.paths.setdefault(fd.path, []).append(fd)
+        if fd.hash is not None:
+            self.hashes.setdefault(fd.hash, []).append(fd)
+        if write_cache:
+            self.write_later(fd)
         return True
 
-    def update(self, root: Path | str):
-        root = Path(root).expanduser()
-        pbar = tqdm(sorted(root.rglob("*")))
-        for path in pbar:
-            if path.is_file() and str(path) not in self.paths:
-                fd = FileDescriptor.from_file(path)
-                self.add(fd)
-            relpath = str(path.relative_to(root))
+    def remove(self, fd: FileDescriptor):
+        del self.items[fd.path]
+        self._items_list = None
+        for mapping, key in [(self.sizes, fd.size), (self.paths, fd.path), (self.hashes, fd.hash)]:
+            if key in mapping:
+                # compare by identity, generated __eq__ compares all the fields
+                mapping[key] = [other for other in mapping[key] if other is not fd]
+                # don't leave empty lists, "key in mapping" is used as a membership test
+                if not mapping[key]:
+                    del mapping[key]
+
+    def write_later(self, fd: FileDescriptor):
+        self.pending.append(fd)
+        if len(self.pending) >= CACHE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.write_to_cache(self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+        self.db.close()
+
+    def ensure_hashes(self, fds: list[FileDescriptor], max_workers: int | None = None):
+        """
+        Compute hashes of the given (indexed) files that don't have them yet.
+        """
+        fds = [fd for fd in fds if fd.hash is None]
+        if not fds:
+            return
+        # file I/O and hashing release the GIL, so threads are enough; updating
+        # the index (and writing to the cache file) stays in the calling thread
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as ex:
+            results = ex.map(hash_file, [fd.path for fd in fds])
+            for fd, hash in tqdm(zip(fds, results), total=len(fds)):
+                fd.hash = hash
+                self.hashes.setdefault(hash, []).append(fd)
+                # write in batches, so that an interrupted run keeps most of its work
+                self.write_later(fd)
+        self.flush()
+
+    def update(self, root: Path | str, max_workers: int | None = None, hash_collisions: bool = True):
+        root = os.path.expanduser(str(root)).rstrip("/")
+        pbar = tqdm(iter_files(root))
+        new_fds = []
+        seen = set()
+        for path, st in pbar:
+            seen.add(path)
+            cached = self.paths.get(path)
+            if cached:
+                old_fd = cached[0]
+                if old_fd.size == st.st_size and old_fd.mtime_ns in (st.st_mtime_ns, None):
+                    # unchanged, trust the cache
+                    if old_fd.mtime_ns is None:
+                        # created by an older version or copied by us, remember mtime from now on
+                        old_fd.mtime_ns = st.st_mtime_ns
+                        new_fds.append(old_fd)
+                    continue
+                # file has changed since it was indexed
+                self.remove(old_fd)
+            fd = FileDescriptor.from_stat(path, st)
+            if self.add(fd, write_cache=False):
+                new_fds.append(fd)
+            relpath = path[len(root) + 1:]
             relpath = relpath.rjust(30)[-30:]
             pbar.set_description(relpath)
+        self.write_to_cache(new_fds)
+        if os.path.isdir(root):
+            # forget files deleted since they were indexed, so that nothing tries to read them later;
+            # if root itself is missing (e.g. unmounted drive), keep the cache for when it's back
+            prefix = root + "/"
+            gone = [fd for fd in self if fd.path.startswith(prefix) and fd.path not in seen]
+            for fd in gone:
+                self.remove(fd)
+            self.delete_from_cache(gone)
+        if not hash_collisions:
+            # caller decides which files are worth hashing
+            return
+        # files of different size can't be duplicates, so only hash size collisions;
+        # the cache doesn't record which groups are resolved (e.g. after hash_collisions=False),
+        # so check all of them, cached hashes and short hashes make it cheap for resolved ones
+        groups = [fds for fds in self.sizes.values() if len(fds) > 1]
+        no_short_hash = [fd for g in groups for fd in g if fd._short_hash is None]
+        candidates = full_hash_candidates(groups, max_workers=max_workers)
+        # keep short hashes that ruled out duplicates, so that the files aren't read again next time
+        self.write_to_cache([fd for fd in no_short_hash if fd._short_hash is not None])
+        self.ensure_hashes(candidates, max_workers=max_workers)
+
+
+def find_issues(index: Index | list[FileDescriptor]):
+    """
+    Find duplicates (same size and hash), hash collisions (same hash, different size)
+    and empty files. Duplicates and collisions are returned as (reference, fd) pairs.
+    Files without a hash are skipped: Index.update() only leaves a file unhashed when
+    its size or short hash already rules out duplicates (unless hash_collisions=False).
+    """
+    empty = []
+    groups = defaultdict(lambda: [])    # (size, hash) -> [fd]
+    for fd in index:
+        if fd.size == 0:
+            empty.append(fd)
+        elif fd.hash is not None:
+            groups[(fd.size, fd.hash)].append(fd)
+    duplicates = []
+    refs_by_hash = defaultdict(lambda: [])    # hash -> [first fd of each group]
+    for (_, hash), fds in groups.items():
+        duplicates.extend((fds[0], fd) for fd in fds[1:])
+        refs_by_hash[hash].append(fds[0])
+    collisions = [(refs[0], fd) for refs in refs_by_hash.values() for fd in refs[1:]]
+    return {"duplicates": duplicates, "collisions": collisions, "empty": empty}
+
+
+# [min_size, max_size) of each band, None means no upper limit
+SIZE_BANDS = [(0, 1 << 16), (1 << 16, 1 << 20), (1 << 20, 1 << 24), (1 << 24, None)]
+
+
+def find_issues_by_size_bands(index: Index | list[FileDescriptor], bands=SIZE_BANDS):
+    """
+    Same as find_issues(), but groups one size band at a time, so that memory for
+    grouping is bounded by the largest band. Duplicates always have the same size
+    and are never split between bands, but hash collisions across bands are not reported.
+    """
+    issues = {"duplicates": [], "collisions": [], "empty": []}
+    for min_size, max_size in bands:
+        band = [fd for fd in index if fd.size >= min_size and (max_size is None or fd.size < max_size)]
+        for key, found in find_issues(band).items():
+            issues[key].extend(found)
+    return issues
 
 
 def test_index():
@@ -234,28 +891,84 @@ def test_index():
 #                                 reorganize                                  #
 ###############################################################################
 
-def maybe_increment_path(path: str):
-    if not os.path.exists(path):
-        # already ok
-        return path
-    dirname, basename = os.path.split(path)
-    name, ext = os.path.splitext(basename)
-    match = re.match(r'^(.*?)\s*\((\d+)\)$', name)
-    if match:
-        base = match.group(1)
-        index = int(match.group(2))
-        new_name = f"{base} ({index + 1})"
+# "name (1)" -> ("name", "1")
+INCREMENT_RE = re.compile(r'^(.*?)\s*\((\d+)\)$')
+
+
+def maybe_increment_path(path: str, taken: set[str] | None = None):
+    """
+    Add or increment " (N)" suffix until the path is free. If `taken` is given,
+    it's checked first, so that paths planned but not yet created count as taken.
+    It should hold lowercased paths, so that names that only differ in case (same
+    file on case-insensitive file systems) are treated as taken too. The file system
+    is always checked as well: symlinks (even broken ones) aren't indexed, and
+    copying to one would overwrite its target.
+    """
+    if taken is None:
+        is_taken = os.path.lexists
     else:
-        new_name = f"{name} (1)"
-    new_path = os.path.join(dirname, new_name + ext)
-    return new_path
+        is_taken = lambda p: p.lower() in taken or os.path.lexists(p)
+    while is_taken(path):
+        dirname, basename = os.path.split(path)
+        name, ext = os.path.splitext(basename)
+        match = INCREMENT_RE.match(name)
+        if match:
+            base = match.group(1)
+            index = int(match.group(2))
+            new_name = f"{base} ({index + 1})"
+        else:
+            new_name = f"{name} (1)"
+        path = os.path.join(dirname, new_name + ext)
+    return path
+
+
+def same_device(src: str, dst: str):
+    return os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+
+
+COPY_CHUNK_SIZE = 1 << 30
+
+
+def copy_file_range(src: str, dst: str):
+    """
+    Copy src to dst inside the kernel. On the same file system this may
+    share or clone extents instead of moving the data at all.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        while n := os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK_SIZE):
+            copied += n
+    # some file system combinations return 0 before the end of the file
+    if copied != size:
+        raise OSError(f"copy_file_range() copied {copied} of {size} bytes")
+    shutil.copymode(src, dst)
+
 
+def copy_file(src: str, dst: str):
+    if hasattr(os, "copy_file_range"):
+        try:
+            copy_file_range(src, dst)
+            return
+        except OSError:
+            # not supported by this kernel or file system pair
+            pass
+    # uses sendfile() on Linux and fcopyfile() on macOS
+    shutil.copy(src, dst)
 
-def copy_with_retry(src, dst, n_retries=10):
+
+def copy_with_retry(src, dst, n_retries=10, link=False):
+    """
+    Copy src to dst. If link=True and both are on the same file system,
+    create a hard link instead, so that no data is copied at all.
+    """
     success = False
     while n_retries > 0 and not success:
         try:
-            shutil.copy(src, dst)
+            if link and same_device(src, dst):
+                os.link(src, dst)
+            else:
+                copy_file(src, dst)
             success = True
         except:
             print(f"Failed to copy: {src} -> {dst}. Retrying in 3 seconds...")
@@ -279,35 +992,82 @@ def output_path(fd: FileDescriptor, dst: str):
     return base_out_path
 
 
-def reorganize(src: str | list[str], dest: str):
+def reorganize(src: str | list[str], dest: str, copy_workers: int = 8, link: bool = False):
     if isinstance(src, str) or isinstance(src, Path):
         src = [src]
     print("Indexing source")
-    index = Index()
+    # source size groups are only partially hashed, so keep them out of the default index
+    index = Index(cachefile=os.path.abspath("src-media-index.db"))
     for root in src:
-        index.update(root)
+        index.update(root, hash_collisions=False)
     print("Indexing destination")
-    dest_index = Index(cachefile=os.path.abspath("dest-media-index.jsonl"))
+    dest_index = Index(cachefile=os.path.abspath("dest-media-index.db"))
     dest_index.update(dest)
+    # only non-empty media files are copied, so nothing else in the source needs hashing;
+    # such a file may be a duplicate of another source file or of a destination file of the same size
+    media_sizes = defaultdict(lambda: [])
+    for fd in index:
+        if fd.size > 0 and fd.typ in ("image", "video"):
+            media_sizes[fd.size].append(fd)
+    groups = [fds + dest_index.sizes.get(size, []) for size, fds in media_sizes.items()]
+    candidates = {id(fd) for fd in full_hash_candidates(groups)}
+    index.ensure_hashes([fd for fd in index if id(fd) in candidates])
+    dest_index.ensure_hashes([fd for fd in dest_index if id(fd) in candidates])
     print(f"Files already in destination: {len([fd for fd in index if fd.hash in dest_index.hashes])}")
     print(f"Copying to the {dest}")
     dest = os.path.expanduser(dest).rstrip("/")
+    # first decide what to copy and where, then copy in parallel
+    to_copy = []                                # [fd]
+    tasks = []                                  # [(fd, out_path)]
+    planned = defaultdict(lambda: [])           # size -> [fd], files to be copied in this run
+    out_paths = set()
+    # all files in the destination are in the index, so we don't need to stat() candidate paths
+    taken = {path.lower() for path in dest_index.paths}
+    # (size, hash) of hashed files in the destination and of planned files
+    known = {(dest_fd.size, dest_fd.hash) for dest_fd in dest_index if dest_fd.hash is not None}
     for fd in tqdm(index):
         # if file is invalid or not a media, then skip
         if fd.size == 0 or (fd.typ != "image" and fd.typ != "video"):
             continue
-        # if there's already such a file in the destination, then skip
-        dest_fds = dest_index.hashes[fd.hash]
+        # if there's already such a file in the destination (or it's already planned), then skip;
+        # duplicates are usually hashed by now, so try a single lookup before comparing files one by one
+        if fd.hash is not None and (fd.size, fd.hash) in known:
+            continue
+        dest_fds = dest_index.sizes.get(fd.size, []) + planned.get(fd.size, [])
         if any(fd.is_same(dest_fd) for dest_fd in dest_fds):
             continue
         # otherwise, copy file
-        base_out_path = output_path(fd, dest)
-        out_path = maybe_increment_path(base_out_path)
-        os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        copy_with_retry(fd.path, out_path)
-        dest_fd = deepcopy(fd)
-        dest_fd.path = out_path
-        dest_index.add(dest_fd)
+        planned[fd.size].append(fd)
+        if fd.hash is not None:
+            known.add((fd.size, fd.hash))
+        to_copy.append(fd)
+    # output path depends on record time, which means reading metadata of every file that isn't
+    # in the cache yet; it's I/O bound, so read it in parallel instead of one file at a time
+    unread = [fd for fd in to_copy if fd._record_time is NOT_COMPUTED]
+    with ThreadPoolExecutor() as ex:
+        list(tqdm(ex.map(lambda fd: fd.record_time, unread), total=len(unread)))
+    for fd in to_copy:
+        base_out_path = os.path.normpath(output_path(fd, dest))
+        out_path = maybe_increment_path(base_out_path, taken=taken)
+        taken.add(out_path.lower())
+        out_paths.add(out_path)
+        tasks.append((fd, out_path))
+        # save record time and metadata, so that an interrupted run doesn't have to read them again
+        index.write_later(fd)
+    index.flush()
+    for dirname in {os.path.dirname(out_path) for out_path in out_paths}:
+        os.makedirs(dirname, exist_ok=True)
+    # start with the largest files, so that a big video doesn't keep a single worker busy at the very end
+    tasks.sort(key=lambda task: task[0].size, reverse=True)
+    # copying is I/O bound, so threads are enough; index is only updated from this thread
+    with ThreadPoolExecutor(max_workers=copy_workers) as ex:
+        results = ex.map(lambda task: copy_with_retry(task[0].path, task[1], link=link), tasks)
+        for (fd, out_path), _ in tqdm(zip(tasks, results), total=len(tasks)):
+            # replace() creates a fresh descriptor, so properties cached for the source path don't leak
+            # copy gets its own mtime, which is picked up on the next scan of the destination
+            dest_fd = replace(fd, path=out_path, mtime_ns=None)
+            dest_index.add(dest_fd)
+    dest_index.flush()
     print("Done!")
 
 
@@ -322,17 +1082,14 @@ def main():
 
 
     dest = "/Volumes/Elements/photos/2019/7"
-    index = Index(cachefile="test.jsonl")
+    index = Index(cachefile="test.db")
     index.update(dest)
 
-    out = set([])
-    for h, fds in tqdm(index.hashes.items()):
-        for i in range(len(fds) - 1):
-            for j in range(i + 1, len(fds)):
-                # print(f"i = {i}; j = {j}")
-                if not fds[i].is_same(fds[j]):
-                    print(f"fds[{i}] != fds[{j}]")
-                    out.add(h)
-    for h in out:
-        print(index.hashes[h])
-        print()
\ No newline at end of file
+    issues = find_issues(index)
+    for ref, fd in issues["collisions"]:
+        print(f"{ref} != {fd}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
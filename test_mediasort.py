@@ -0,0 +1,271 @@
+import struct
+from datetime import datetime
+
+import pytest
+
+import mediasort
+
+
+DATE_TIME = b"2011:02:03 04:05:06\0"
+DATE_TIME_ORIGINAL = b"2012:03:04 05:06:07\0"
+
+
+def make_tiff(endian: str, exif_ifd=True):
+    """
+    Build a minimal TIFF structure: IFD0 with DateTime (and a pointer to the Exif IFD,
+    which holds DateTimeOriginal), followed by the strings themselves.
+    """
+    header = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HI", 42, 8)
+    n_entries = 2 if exif_ifd else 1
+    ifd0_end = 8 + 2 + 12 * n_entries + 4
+    exif_end = ifd0_end + (2 + 12 + 4 if exif_ifd else 0)
+    ifd0 = struct.pack(endian + "H", n_entries)
+    ifd0 += struct.pack(endian + "HHII", 0x0132, 2, len(DATE_TIME), exif_end)
+    if exif_ifd:
+        ifd0 += struct.pack(endian + "HHII", mediasort.EXIF_IFD_POINTER, 4, 1, ifd0_end)
+    ifd0 += struct.pack(endian + "I", 0)
+    exif = b""
+    if exif_ifd:
+        exif = struct.pack(endian + "H", 1)
+        exif += struct.pack(endian + "HHII", 0x9003, 2, len(DATE_TIME_ORIGINAL), exif_end + len(DATE_TIME))
+        exif += struct.pack(endian + "I", 0)
+    return header + ifd0 + exif + DATE_TIME + DATE_TIME_ORIGINAL
+
+
+def segment(marker: int, payload: bytes):
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def make_jpeg(*segments: bytes):
+    return b"\xff\xd8" + b"".join(segments) + b"\xff\xda\x00\x02" + b"scan data"
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_tiff_datetimes(endian):
+    meta = mediasort.tiff_datetimes(make_tiff(endian))
+    assert meta == {"DateTime": "2011:02:03 04:05:06", "DateTimeOriginal": "2012:03:04 05:06:07"}
+
+
+def test_tiff_datetimes_without_exif_ifd():
+    assert mediasort.tiff_datetimes(make_tiff("<", exif_ifd=False)) == {"DateTime": "2011:02:03 04:05:06"}
+
+
+def test_tiff_datetimes_not_tiff():
+    assert mediasort.tiff_datetimes(b"XX\0\0\0\0\0\0") is None
+
+
+def test_tiff_datetimes_out_of_bounds():
+    with pytest.raises(struct.error):
+        mediasort.tiff_datetimes(make_tiff("<")[:-30])
+
+
+def test_jpeg_exif_metadata(tmp_path):
+    path = tmp_path / "a.jpg"
+    jfif = segment(0xE0, b"JFIF\0" + b"\0" * 9)
+    path.write_bytes(make_jpeg(jfif, segment(0xE1, b"Exif\0\0" + make_tiff(">"))))
+    meta = mediasort.jpeg_exif_metadata(str(path))
+    assert meta == {"DateTime": "2011:02:03 04:05:06", "DateTimeOriginal": "2012:03:04 05:06:07"}
+
+
+def test_jpeg_exif_metadata_after_xmp_and_large_segments(tmp_path):
+    path = tmp_path / "a.jpg"
+    xmp = segment(0xE1, b"http://ns.adobe.com/xap/1.0/\0<x:xmpmeta/>")
+    icc = segment(0xE2, b"\0" * 65000)
+    exif = segment(0xE1, b"Exif\0\0" + make_tiff("<"))
+    # fill bytes before a marker are allowed
+    path.write_bytes(make_jpeg(b"\xff\xff", xmp, icc, icc, exif))
+    assert mediasort.jpeg_exif_metadata(str(path))["DateTimeOriginal"] == "2012:03:04 05:06:07"
+
+
+def test_jpeg_exif_metadata_without_exif(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(make_jpeg(segment(0xE0, b"JFIF\0" + b"\0" * 9)))
+    assert mediasort.jpeg_exif_metadata(str(path)) == {}
+
+
+@pytest.mark.parametrize("data", [
+    b"\x89PNG\r\n\x1a\n",                                          # not a JPEG
+    make_jpeg(segment(0xE1, b"Exif\0\0" + make_tiff("<")))[:40],   # truncated
+    b"\xff\xd8\xff\xe1\x00\x01",                                   # invalid segment length
+])
+def test_jpeg_exif_metadata_invalid(tmp_path, data):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(data)
+    assert mediasort.jpeg_exif_metadata(str(path)) is None
+
+
+@pytest.mark.parametrize("meta, expected", [
+    ({"DateTimeOriginal": "2012:03:04 05:06:07", "DateTime": "2011:02:03 04:05:06"}, "2012-03-04 05:06:07"),
+    ({"DateTimeOriginal": "0000:00:00 00:00:00", "DateTime": "2011:02:03 04:05:06"}, "2011-02-03 04:05:06"),
+    ({"DateTimeOriginal": "    :  :     :  :  "}, "2015-03-01 00:00:00"),
+    ({}, "2015-03-01 00:00:00"),
+])
+def test_image_record_time(meta, expected):
+    fd = mediasort.FileDescriptor(path="/photos/2015/03/a.jpg", size=1, hash=None, typ="image", _meta=meta)
+    assert str(fd.record_time) == expected
+
+
+def atom(kind: bytes, payload: bytes):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+def mvhd(version: int, creation_time: int):
+    fmt = ">QQ" if version == 1 else ">II"
+    return atom(b"mvhd", bytes([version, 0, 0, 0]) + struct.pack(fmt, creation_time, creation_time) + b"\0" * 80)
+
+
+MP4_CREATION_TIME = int((datetime(2019, 7, 1, 10, 11, 12) - datetime(1904, 1, 1)).total_seconds())
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_mp4_creation_time(tmp_path, version):
+    path = tmp_path / "a.mp4"
+    moov = atom(b"moov", atom(b"trak", b"\0" * 10) + mvhd(version, MP4_CREATION_TIME))
+    path.write_bytes(atom(b"ftyp", b"isom\0\0\0\0") + atom(b"mdat", b"\0" * 1000) + moov)
+    assert mediasort.mp4_creation_time(str(path)) == MP4_CREATION_TIME
+    meta = mediasort.video_metadata(str(path))
+    assert meta == {"format": {"tags": {"creation_time": "2019-07-01T10:11:12.000000Z"}}}
+
+
+def test_mp4_creation_time_64bit_atom_size(tmp_path):
+    path = tmp_path / "a.mov"
+    mdat = struct.pack(">I4sQ", 1, b"mdat", 16 + 5) + b"12345"
+    path.write_bytes(atom(b"ftyp", b"qt  ") + mdat + atom(b"moov", mvhd(0, MP4_CREATION_TIME)))
+    assert mediasort.mp4_creation_time(str(path)) == MP4_CREATION_TIME
+
+
+@pytest.mark.parametrize("data", [
+    b"RIFF\0\0\0\0AVI ",                                  # not a MP4
+    atom(b"ftyp", b"isom") + atom(b"mdat", b"\0" * 10),  # no moov
+    struct.pack(">I4s", 4, b"ftyp"),                      # invalid atom size
+])
+def test_mp4_creation_time_invalid(tmp_path, data):
+    path = tmp_path / "a.mp4"
+    path.write_bytes(data)
+    assert mediasort.mp4_creation_time(str(path)) is None
+
+
+@pytest.mark.parametrize("creation_time, expected", [
+    (0, {}),                                                         # unset
+    (1561975872, {"creation_time": "2019-07-01T10:11:12.000000Z"}),  # Unix time
+])
+def test_video_metadata_creation_time(tmp_path, creation_time, expected):
+    path = tmp_path / "a.mp4"
+    path.write_bytes(atom(b"ftyp", b"isom") + atom(b"moov", mvhd(0, creation_time)))
+    assert mediasort.video_metadata(str(path)) == {"format": {"tags": expected}}
+
+
+def test_index_update_forgets_deleted_files(tmp_path):
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "a.jpg").write_bytes(b"a" * 100)
+    (root / "b.jpg").write_bytes(b"b" * 50)
+    cachefile = str(tmp_path / "index.db")
+    index = mediasort.Index(cachefile=cachefile)
+    index.update(root)
+    index.close()
+    # a.jpg has a unique size, so it's cached without a hash; a new file of the same size
+    # must not make the index hash the deleted one
+    (root / "a.jpg").unlink()
+    (root / "c.jpg").write_bytes(b"c" * 100)
+    index = mediasort.Index(cachefile=cachefile)
+    index.update(root)
+    assert sorted(fd.name for fd in index) == ["b.jpg", "c.jpg"]
+    index.close()
+    assert sorted(fd.name for fd in mediasort.Index(cachefile=cachefile)) == ["b.jpg", "c.jpg"]
+
+
+def test_reorganize_after_destination_file_deleted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    src, dest = tmp_path / "src", tmp_path / "dest"
+    (src / "2016" / "01").mkdir(parents=True)
+    (dest / "2015" / "05").mkdir(parents=True)
+    size = 200 * 1024
+    (dest / "2015" / "05" / "old.jpg").write_bytes(b"o" * size)
+    mediasort.reorganize(str(src), str(dest))
+    # the destination file is cached without a hash; a source file of the same size
+    # must not make reorganize read the deleted one
+    (dest / "2015" / "05" / "old.jpg").unlink()
+    (src / "2016" / "01" / "p.jpg").write_bytes(b"p" * size)
+    mediasort.reorganize(str(src), str(dest))
+    assert (dest / "2016" / "01" / "p.jpg").read_bytes() == b"p" * size
+
+
+def test_index_getitem(tmp_path):
+    index = mediasort.Index(cachefile=str(tmp_path / "index.db"))
+    fds = [mediasort.FileDescriptor(path=f"/photos/{i}.jpg", size=i, hash=None, typ="image") for i in range(3)]
+    for fd in fds:
+        index.add(fd, write_cache=False)
+    assert [index[i] for i in range(len(index))] == fds
+    index.remove(fds[1])
+    assert index[1] is fds[2]
+    index.close()
+
+
+def test_reorganize_does_not_write_through_symlinks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    src, dest = tmp_path / "src", tmp_path / "dest"
+    (src / "2016" / "01").mkdir(parents=True)
+    (dest / "2016" / "01").mkdir(parents=True)
+    outside = tmp_path / "outside.jpg"
+    outside.write_bytes(b"outside")
+    (dest / "2016" / "01" / "p.jpg").symlink_to(outside)
+    (src / "2016" / "01" / "p.jpg").write_bytes(b"photo")
+    mediasort.reorganize(str(src), str(dest))
+    assert outside.read_bytes() == b"outside"
+    assert (dest / "2016" / "01" / "p (1).jpg").read_bytes() == b"photo"
+
+
+def test_find_issues_after_reorganize(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    src, dest = tmp_path / "src", tmp_path / "dest"
+    src.mkdir()
+    dest.mkdir()
+    (src / "a.json").write_bytes(b"{}")
+    (src / "b.json").write_bytes(b"{}")
+    mediasort.reorganize(str(src), str(dest))
+    index = mediasort.Index()
+    index.update(src)
+    assert len(mediasort.find_issues(index)["duplicates"]) == 1
+    index.close()
+
+
+def test_index_update_resolves_cached_size_groups(tmp_path):
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "a.jpg").write_bytes(b"a" * 100)
+    (root / "b.jpg").write_bytes(b"a" * 100)
+    cachefile = str(tmp_path / "index.db")
+    index = mediasort.Index(cachefile=cachefile)
+    index.update(root, hash_collisions=False)
+    index.close()
+    # no new files, but the group is still unresolved in the cache
+    index = mediasort.Index(cachefile=cachefile)
+    index.update(root)
+    assert len(mediasort.find_issues(index)["duplicates"]) == 1
+    index.close()
+
+
+@pytest.mark.parametrize("s, expected", [
+    ("2019-07-01T10:11:12.000000Z", datetime(2019, 7, 1, 10, 11, 12)),
+    ("2019-07-01T10:11:12.5Z", datetime(2019, 7, 1, 10, 11, 12, 500000)),
+])
+def test_parse_iso_datetime(s, expected):
+    assert mediasort.parse_iso_datetime(s) == expected
+
+
+@pytest.mark.parametrize("s", ["2019-07-01 10:11:12", "2019-07-01T10:11:12Z", ""])
+def test_parse_iso_datetime_invalid(s):
+    with pytest.raises(ValueError):
+        mediasort.parse_iso_datetime(s)
+
+
+@pytest.mark.parametrize("creation_time, expected", [
+    ("2019-07-01T10:11:12.000000Z", "2019-07-01 10:11:12"),
+    ("2019-07-01 10:11:12", "2015-03-01 00:00:00"),
+    ("1970-01-01T00:00:00.000000Z", "2015-03-01 00:00:00"),
+])
+def test_video_record_time(creation_time, expected):
+    meta = {"format": {"tags": {"creation_time": creation_time}}}
+    fd = mediasort.FileDescriptor(path="/videos/2015/03/a.avi", size=1, hash=None, typ="video", _meta=meta)
+    assert str(fd.record_time) == expected